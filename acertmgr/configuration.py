@@ -212,7 +212,7 @@ def load():
         runtimeconfig['work_dir'] = domain_config_dir
     #  create work_dir if it does not exist yet
     if not os.path.isdir(runtimeconfig['work_dir']):
-        os.mkdir(runtimeconfig['work_dir'], int("0700", 8))
+        os.mkdir(runtimeconfig['work_dir'], 0o700)
 
     # - authority_tos_agreement
     if args.authority_tos_agreement:
@@ -5,8 +5,8 @@
 # available under the ISC license, see LICENSE
 
 import ipaddress
-import re
 import socket
+import threading
 import time
 from datetime import datetime, timedelta
 
@@ -16,39 +16,46 @@ import dns.resolver
 import dns.tsigkeyring
 import dns.update
 
+try:
+    import queue  # Python 3
+except ImportError:
+    import Queue as queue  # Python 2
+
 from acertmgr import tools
 from acertmgr.modes.abstract import AbstractChallengeHandler
 from acertmgr.tools import log
 
 QUERY_TIMEOUT = 60  # seconds are the maximum for any query (otherwise the DNS server will be considered dead)
-REGEX_IP4 = r'^(?:[0-9]{1,3}\.){3}[0-9]{1,3}$'
-REGEX_IP6 = r'^(([0-9a-fA-F]{1,4}:){7,7}[0-9a-fA-F]{1,4}|([0-9a-fA-F]{1,4}:){1,7}' \
-            r':|([0-9a-fA-F]{1,4}:){1,6}:[0-9a-fA-F]{1,4}|([0-9a-fA-F]{1,4}:){1,5}' \
-            r'(:[0-9a-fA-F]{1,4}){1,2}|([0-9a-fA-F]{1,4}:){1,4}(:[0-9a-fA-F]{1,4}){1,3}' \
-            r'|([0-9a-fA-F]{1,4}:){1,3}(:[0-9a-fA-F]{1,4}){1,4}|([0-9a-fA-F]{1,4}:){1,2}' \
-            r'(:[0-9a-fA-F]{1,4}){1,5}|[0-9a-fA-F]{1,4}:((:[0-9a-fA-F]{1,4}){1,6})' \
-            r'|:((:[0-9a-fA-F]{1,4}){1,7}|:)|fe80:(:[0-9a-fA-F]{0,4}){0,4}%[0-9a-zA-Z]{1,}' \
-            r'|::(ffff(:0{1,4}){0,1}:){0,1}((25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])\.){3,3}' \
-            r'(25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])|([0-9a-fA-F]{1,4}:){1,4}' \
-            r':((25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])\.){3,3}(25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9]))$'
+QUERY_RETRIES = 4  # udp queries are retried with exponential backoff (4+8+16+32 seconds add up to QUERY_TIMEOUT)
+QUERY_RETRY_TIMEOUT = 4  # seconds to wait for the first udp query attempt
 _lookup_ip_cache = {}
 _lookup_ns_ip_cache = {}
 _lookup_zone_cache = {}
+_default_nameservers = []
 
 
 class DNSChallengeHandler(AbstractChallengeHandler):
+    @staticmethod
+    def _udp_query(request, nameserver, timeout=QUERY_RETRY_TIMEOUT, retries=QUERY_RETRIES):
+        for attempt in range(retries):
+            try:
+                return dns.query.udp(request, nameserver, timeout=timeout * (1 << attempt))
+            except dns.exception.Timeout:
+                if attempt + 1 >= retries:
+                    raise
+
     @staticmethod
     def _lookup_ip(domain_or_ip):
         if domain_or_ip in _lookup_ip_cache:
             return _lookup_ip_cache[domain_or_ip]
 
+        stripped = domain_or_ip.strip()
         try:
-            if re.search(REGEX_IP4, domain_or_ip.strip()) or re.search(REGEX_IP6, domain_or_ip.strip()):
-                return str(ipaddress.ip_address(domain_or_ip))
+            return str(ipaddress.ip_address(stripped))
         except ValueError:
             pass
         # No valid ip found so far, try to resolve using system resolver
-        result = socket.getaddrinfo(domain_or_ip, 53)
+        result = socket.getaddrinfo(stripped, 53)
         if len(result) > 0:
             retval = result[0][4][0]
             _lookup_ip_cache[domain_or_ip] = retval
@@ -67,7 +74,7 @@ class DNSChallengeHandler(AbstractChallengeHandler):
             nameserver = DNSChallengeHandler._lookup_ip(zonemaster)
 
         request = dns.message.make_query(zone, dns.rdatatype.NS)
-        response = dns.query.udp(request, nameserver, timeout=QUERY_TIMEOUT)
+        response = DNSChallengeHandler._udp_query(request, nameserver)
         retval = set()
         if response.rcode() == dns.rcode.NOERROR:
             for answer in response.answer:
@@ -77,6 +84,86 @@ class DNSChallengeHandler(AbstractChallengeHandler):
             _lookup_ns_ip_cache[cache_key] = retval
         return retval
 
+    @staticmethod
+    def _get_default_nameservers():
+        if not _default_nameservers:
+            _default_nameservers.extend(dns.resolver.get_default_resolver().nameservers)
+        return _default_nameservers
+
+    # @brief query the given nameserver for the SOA of domain
+    # @return tuple of (zone, authoritative ns) or None, and whether the remaining nameservers should be asked
+    @staticmethod
+    def _query_soa(domain, nameserver):
+        request = dns.message.make_query(domain, dns.rdatatype.SOA)
+        try:
+            response = DNSChallengeHandler._udp_query(request, nameserver)
+        except dns.exception.Timeout:
+            # Go to next nameserver on timeout
+            return None, True
+        except dns.exception.DNSException:
+            # Stop at this level on any other error
+            return None, False
+
+        if response.rcode() in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN):
+            zone, soa = None, None
+            for answer in response.answer:
+                for item in answer:
+                    if item.rdtype == dns.rdatatype.SOA:
+                        zone, soa = domain, item
+            if not response.answer:
+                # Negative responses contain the SOA of the enclosing zone in their authority section
+                for authority in response.authority:
+                    # Ignore root and top level zones, the same as the lookup loop (those are never updatable)
+                    if authority.rdtype == dns.rdatatype.SOA and domain.is_subdomain(authority.name) \
+                            and authority.name != dns.name.root and authority.name.parent() != dns.name.root:
+                        zone, soa = authority.name, authority[0]
+            if soa:
+                return (zone.to_text(), soa.mname.to_text().split(' ')[0]), False
+            # Name does not exist, continue with parent domain (otherwise ask next nameserver)
+            return None, response.rcode() != dns.rcode.NXDOMAIN
+        elif response.rcode() in (dns.rcode.REFUSED, dns.rcode.SERVFAIL):
+            # Nameserver is unable to answer, go to next nameserver
+            return None, True
+        return None, False
+
+    # @brief query all nameservers for the SOA of domain (concurrently if there are several)
+    # @return tuple of (zone, authoritative ns) or None
+    @staticmethod
+    def _lookup_soa(domain, nameservers):
+        if not nameservers:
+            return None
+        if len(nameservers) == 1:
+            retval, _ = DNSChallengeHandler._query_soa(domain, nameservers[0])
+            return retval
+
+        results = queue.Queue()
+
+        def query_soa(nameserver):
+            try:
+                results.put((DNSChallengeHandler._query_soa(domain, nameserver), None))
+            except Exception as e:
+                results.put(((None, True), e))
+
+        for nameserver in nameservers:
+            worker = threading.Thread(target=query_soa, args=(nameserver,))
+            # Outstanding queries of dead nameservers must neither be waited for nor delay the process exit
+            worker.daemon = True
+            worker.start()
+
+        error = None
+        for _ in nameservers:
+            (retval, try_next), exc = results.get()
+            if retval:
+                return retval
+            if not try_next:
+                # Answer means the remaining nameservers need not be asked (same as a sequential lookup)
+                return None
+            error = error or exc
+        if error:
+            # No nameserver provided an answer, report the first failure
+            raise error
+        return None
+
     @staticmethod
     def _lookup_zone(domain, nameserver=None):
         cache_key = "{}${}".format(domain, nameserver)
@@ -86,48 +173,38 @@ class DNSChallengeHandler(AbstractChallengeHandler):
         if nameserver:
             nameservers = [nameserver]
         else:
-            nameservers = dns.resolver.get_default_resolver().nameservers
+            nameservers = DNSChallengeHandler._get_default_nameservers()
 
         domain = dns.name.from_text(domain)
         if not domain.is_absolute():
             domain = domain.concatenate(dns.name.root)
 
         while domain.parent() != dns.name.root:
-            request = dns.message.make_query(domain, dns.rdatatype.SOA)
-            for nameserver in nameservers:
-                try:
-                    response = dns.query.udp(request, nameserver, timeout=QUERY_TIMEOUT)
-                    if response.rcode() == dns.rcode.NOERROR:
-                        for answer in response.answer:
-                            for item in answer:
-                                if item.rdtype == dns.rdatatype.SOA:
-                                    zone = domain.to_text()
-                                    authoritative_ns = item.mname.to_text().split(' ')[0]
-                                    retval = zone, authoritative_ns
-                                    _lookup_zone_cache[cache_key] = retval
-                                    return retval
-                    else:
-                        break
-                except dns.exception.Timeout:
-                    # Go to next nameserver on timeout
-                    continue
-                except dns.exception.DNSException:
-                    # Break loop on any other error
-                    break
+            retval = DNSChallengeHandler._lookup_soa(domain, nameservers)
+            if retval:
+                _lookup_zone_cache[cache_key] = retval
+                return retval
             domain = domain.parent()
         raise ValueError('No zone SOA for "{0}"'.format(domain))
 
-    @staticmethod
-    def _check_txt_record_value(domain, txtvalue, nameserverip, use_tcp=False):
+    # @brief send a message to the nameserver using tcp (handlers may override this to reuse connections)
+    def _tcp_query(self, request, nameserverip):
+        return dns.query.tcp(request, nameserverip, timeout=QUERY_TIMEOUT)
+
+    def _check_txt_record_value(self, domain, txtvalue, nameserverip, use_tcp=False):
         try:
             request = dns.message.make_query(domain, dns.rdatatype.TXT)
             if use_tcp:
-                response = dns.query.tcp(request, nameserverip, timeout=QUERY_TIMEOUT)
+                response = self._tcp_query(request, nameserverip)
             else:
-                response = dns.query.udp(request, nameserverip, timeout=QUERY_TIMEOUT)
+                response = DNSChallengeHandler._udp_query(request, nameserverip)
+            txtdata = txtvalue.encode('ascii')
             for rrset in response.answer:
+                if rrset.rdtype != dns.rdatatype.TXT:
+                    # Skip other records (e.g. CNAME) contained in the answer
+                    continue
                 for answer in rrset:
-                    if answer.to_text().strip('"') == txtvalue:
+                    if b''.join(answer.strings) == txtdata:
                         return True
         except dns.exception.DNSException:
             # Ignore DNS errors and return failure
@@ -6,29 +6,41 @@
 # available under the ISC license, see LICENSE
 import io
 import re
+import socket
 
 import dns
 import dns.query
 import dns.tsigkeyring
 import dns.update
+import dns.version
 
 from acertmgr.modes.dns.abstract import DNSChallengeHandler, QUERY_TIMEOUT
 from acertmgr.tools import log
 
 DEFAULT_KEY_ALGORITHM = "HMAC-MD5.SIG-ALG.REG.INT"
+REGEX_KEY_NAME = re.compile(r"key \"?([^\"{ ]+?)\"? {.*};", re.DOTALL)
+REGEX_KEY_ALGORITHM = re.compile(r"algorithm ([a-zA-Z0-9_-]+?);", re.DOTALL)
+REGEX_KEY_SECRET = re.compile(r"secret \"(.*?)\"", re.DOTALL)
+_key_data_regex_cache = {}
 
 
 class ChallengeHandler(DNSChallengeHandler):
+    @staticmethod
+    def _key_data_regex(key_name):
+        if key_name not in _key_data_regex_cache:
+            _key_data_regex_cache[key_name] = re.compile(r"key \"?%s\"? {(.*?)};" % re.escape(key_name), re.DOTALL)
+        return _key_data_regex_cache[key_name]
+
     @staticmethod
     def _read_tsigkey(tsig_key_file, key_name=None):
         try:
-            with io.open(tsig_key_file) as key_file:
-                key_struct = key_file.read()
-                if not key_name:
-                    key_name = re.search(r"key \"?([^\"{ ]+?)\"? {.*};", key_struct, re.DOTALL).group(1)
-                key_data = re.search(r"key \"?%s\"? {(.*?)};" % key_name, key_struct, re.DOTALL).group(1)
-                algorithm = re.search(r"algorithm ([a-zA-Z0-9_-]+?);", key_data, re.DOTALL).group(1)
-                tsig_secret = re.search(r"secret \"(.*?)\"", key_data, re.DOTALL).group(1)
+            with io.open(tsig_key_file, 'rb') as key_file:
+                key_struct = key_file.read().decode('utf-8')
+            if not key_name:
+                key_name = REGEX_KEY_NAME.search(key_struct).group(1)
+            key_data = ChallengeHandler._key_data_regex(key_name).search(key_struct).group(1)
+            algorithm = REGEX_KEY_ALGORITHM.search(key_data).group(1)
+            tsig_secret = REGEX_KEY_SECRET.search(key_data).group(1)
         except IOError as exc:
             raise ValueError("A problem was encountered opening your keyfile '{}': {}".format(tsig_key_file, exc))
         except AttributeError as exc:
@@ -56,8 +68,56 @@ class ChallengeHandler(DNSChallengeHandler):
         self.nsupdate_server = config.get("nsupdate_server")
         self.nsupdate_verify = config.get("nsupdate_verify", "true") == "true"
         self.nsupdate_verified = False
+        self._zone_cache = {}
+        self._tcp_sockets = {}
+
+    def __del__(self):
+        self.close()
+
+    # @brief close all tcp connections kept open to nameservers
+    def close(self):
+        for nameserverip in list(getattr(self, '_tcp_sockets', {})):
+            self._close_tcp_socket(nameserverip)
+
+    def _open_tcp_socket(self, nameserverip):
+        if nameserverip not in self._tcp_sockets:
+            sock = socket.create_connection((nameserverip, 53), QUERY_TIMEOUT)
+            sock.setblocking(False)  # dnspython expects a nonblocking connected socket
+            self._tcp_sockets[nameserverip] = sock
+        return self._tcp_sockets[nameserverip]
+
+    def _close_tcp_socket(self, nameserverip):
+        sock = self._tcp_sockets.pop(nameserverip, None)
+        if sock:
+            sock.close()
+
+    def _tcp_query(self, request, nameserverip):
+        if dns.version.MAJOR < 2:
+            # Passing a connected socket is only supported by dnspython 2.0 and later
+            return DNSChallengeHandler._tcp_query(self, request, nameserverip)
+
+        reused = nameserverip in self._tcp_sockets
+        try:
+            return dns.query.tcp(request, nameserverip, timeout=QUERY_TIMEOUT, sock=self._open_tcp_socket(nameserverip))
+        except (EOFError, socket.error):
+            self._close_tcp_socket(nameserverip)
+            if not reused:
+                raise
+        except Exception:
+            # Never reuse a connection in an unknown state
+            self._close_tcp_socket(nameserverip)
+            raise
+        # Connection has been closed by the nameserver in the meantime, retry once using a new connection
+        try:
+            return dns.query.tcp(request, nameserverip, timeout=QUERY_TIMEOUT, sock=self._open_tcp_socket(nameserverip))
+        except Exception:
+            self._close_tcp_socket(nameserverip)
+            raise
 
     def _determine_zone_and_nameserverip(self, domain):
+        if domain in self._zone_cache:
+            return self._zone_cache[domain]
+
         nameserver = self.nsupdate_server
         if nameserver:
             nameserverip = self._lookup_ip(nameserver)
@@ -65,6 +125,7 @@ class ChallengeHandler(DNSChallengeHandler):
         else:
             zone, nameserver = self._lookup_zone(domain)
             nameserverip = self._lookup_ip(nameserver)
+        self._zone_cache[domain] = zone, nameserverip
         return zone, nameserverip
 
     def add_dns_record(self, domain, txtvalue):
@@ -72,14 +133,18 @@ class ChallengeHandler(DNSChallengeHandler):
         update = dns.update.Update(zone, keyring=self.keyring, keyalgorithm=self.keyalgorithm)
         update.add(domain, self.dns_ttl, dns.rdatatype.TXT, txtvalue)
         log('Adding \'{} {} IN TXT "{}"\' to {}'.format(domain, self.dns_ttl, txtvalue, nameserverip))
-        dns.query.tcp(update, nameserverip, timeout=QUERY_TIMEOUT)
+        self._tcp_query(update, nameserverip)
 
     def remove_dns_record(self, domain, txtvalue):
         zone, nameserverip = self._determine_zone_and_nameserverip(domain)
         update = dns.update.Update(zone, keyring=self.keyring, keyalgorithm=self.keyalgorithm)
         update.delete(domain, dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.TXT, txtvalue))
         log('Deleting \'{} {} IN TXT "{}"\' from {}'.format(domain, self.dns_ttl, txtvalue, nameserverip))
-        dns.query.tcp(update, nameserverip, timeout=QUERY_TIMEOUT)
+        try:
+            self._tcp_query(update, nameserverip)
+        finally:
+            # The challenge is finished, do not keep connections open (handlers live for the whole process)
+            self.close()
 
     def verify_dns_record(self, domain, txtvalue):
         if self.nsupdate_verify and not self.dns_verify_all_ns and not self.nsupdate_verified:
@@ -7,7 +7,10 @@
 # available under the ISC license, see LICENSE
 
 import base64
+import collections
 import datetime
+import errno
+import hashlib
 import io
 import os
 import stat
@@ -38,6 +41,10 @@ except ImportError:
     from urllib2 import urlopen, Request  # Python 2
 
 
+_BACKEND = default_backend()  # retrieve the cryptography backend only once
+_key_alg_and_jwk_cache = {}
+
+
 class InvalidCertificateError(Exception):
     pass
 
@@ -45,7 +52,8 @@ class InvalidCertificateError(Exception):
 # @brief a simple, portable indent function
 def indent(text, spaces=0):
     ind = ' ' * spaces
-    return os.linesep.join(ind + line for line in text.splitlines())
+    lines = text.splitlines()
+    return ind + (os.linesep + ind).join(lines) if lines else ''
 
 
 # @brief wrapper for log output
@@ -60,20 +68,25 @@ def log(msg, exc=None, error=False, warning=False):
     output = prefix + msg
     if exc:
         _, exc_value, _ = sys.exc_info()
-        if not getattr(exc, '__traceback__', None) and exc == exc_value:
+        exc_traceback = getattr(exc, '__traceback__', None)
+        if not exc_traceback and exc == exc_value:
             # Traceback handling on Python 2 is ugly, so we only output it if the exception is the current sys one
             formatted_exc = traceback.format_exc()
+        elif not exc_traceback:
+            # No traceback available, only the exception itself can be shown
+            formatted_exc = traceback.format_exception_only(type(exc), exc)
         else:
-            formatted_exc = traceback.format_exception(type(exc), exc, getattr(exc, '__traceback__', None))
+            formatted_exc = traceback.format_exception(type(exc), exc, exc_traceback)
         exc_string = ''.join(formatted_exc) if isinstance(formatted_exc, list) else str(formatted_exc)
         output += os.linesep + indent(exc_string, len(prefix))
 
     if error or warning:
+        sys.stdout.flush()  # write out pending regular messages first to keep the order of messages intact
         sys.stderr.write(output + os.linesep)
         sys.stderr.flush()  # force flush buffers after message was written for immediate display
     else:
+        # regular messages are left to stdout buffering (line buffered on terminals)
         sys.stdout.write(output + os.linesep)
-        sys.stdout.flush()  # force flush buffers after message was written for immediate display
 
 
 # @brief wrapper for downloading an url
@@ -116,7 +129,7 @@ def new_cert_request(names, key, must_staple=False):
             req = req.add_extension(x509.TLSFeature(features=[x509.TLSFeatureType.status_request]), critical=False)
         else:
             log('OCSP must-staple ignored as current version of cryptography does not support the flag.', warning=True)
-    req = req.sign(key, hashes.SHA256(), default_backend())
+    req = req.sign(key, hashes.SHA256(), _BACKEND)
     return req
 
 
@@ -136,7 +149,7 @@ def new_ssl_key(path=None, key_algo=None, key_size=None):
         private_key = rsa.generate_private_key(
             public_exponent=65537,
             key_size=key_size,
-            backend=default_backend()
+            backend=_BACKEND
         )
     elif key_algo.lower() == 'ec':
         if not key_size or key_size == 256:
@@ -148,7 +161,7 @@ def new_ssl_key(path=None, key_algo=None, key_size=None):
         else:
             raise ValueError("Unsupported EC curve size parameter: {}".format(key_size))
         key_format = serialization.PrivateFormat.PKCS8
-        private_key = ec.generate_private_key(curve=key_curve, backend=default_backend())
+        private_key = ec.generate_private_key(curve=key_curve, backend=_BACKEND)
     elif key_algo.lower() == 'ed25519' and "cryptography.hazmat.primitives.asymmetric.ed25519":
         key_format = serialization.PrivateFormat.PKCS8
         private_key = ed25519.Ed25519PrivateKey.generate()
@@ -163,15 +176,18 @@ def new_ssl_key(path=None, key_algo=None, key_size=None):
             format=key_format,
             encryption_algorithm=serialization.NoEncryption(),
         )
-        with io.open(path, 'wb') as pem_out:
-            pem_out.write(pem)
-        if hasattr(os, 'chmod'):
-            try:
-                os.chmod(path, int("0400", 8))
-            except OSError:
-                log('Could not set file permissions on {0}!'.format(path), warning=True)
-        else:
-            log('Keyfile permission handling unavailable on this platform', warning=True)
+        perms = 0o400
+        if not create_file(path, pem, perms):
+            # Existing files keep their permissions when written, so they have to be set afterwards
+            with io.open(path, 'wb') as pem_out:
+                pem_out.write(pem)
+            if hasattr(os, 'chmod'):
+                try:
+                    os.chmod(path, perms)
+                except OSError:
+                    log('Could not set file permissions on {0}!'.format(path), warning=True)
+            else:
+                log('Keyfile permission handling unavailable on this platform', warning=True)
     return private_key
 
 
@@ -181,17 +197,49 @@ def new_ssl_key(path=None, key_algo=None, key_size=None):
 # @param csr indicate whether we are loading a csr
 # @return the key in pyopenssl format
 def read_pem_file(path, key=False, csr=False):
-    with io.open(path, 'r') as f:
-        if key:
-            return serialization.load_pem_private_key(f.read().encode('utf-8'), None, default_backend())
-        elif csr:
-            return x509.load_pem_x509_csr(f.read().encode('utf8'), default_backend())
-        else:
-            return convert_pem_str_to_cert(f.read())
+    with io.open(path, 'rb') as f:
+        data = f.read()
+    if key:
+        return serialization.load_pem_private_key(data, None, _BACKEND)
+    elif csr:
+        return x509.load_pem_x509_csr(data, _BACKEND)
+    else:
+        return convert_pem_str_to_cert(data)
+
+
+# @brief create a new file with the given permissions (avoids a window with default permissions)
+# @note where os.fchmod is unavailable (e.g. Windows) new files get the permissions reduced by the umask
+# @param path path of the file to be created
+# @param data the bytes to write to the file
+# @param perms file permissions to create the file with
+# @return True if the file has been created and written, False if it already exists
+def create_file(path, data, perms):
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), perms)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            return False
+        raise
+    try:
+        with io.open(fd, 'wb') as f:
+            if hasattr(os, 'fchmod'):
+                try:
+                    # The mode passed to os.open is reduced by the umask, apply the exact permissions like chmod does
+                    os.fchmod(fd, perms)
+                except OSError:
+                    log('Could not set file permissions on {0}!'.format(path), warning=True)
+            f.write(data)
+    except Exception:
+        # Do not leave an incomplete file behind, it would be considered valid on the next run
+        os.remove(path)
+        raise
+    return True
 
 
 # @brief write cert data to PEM formatted file
 def write_pem_file(crt, path, perms=None):
+    if perms and create_file(path, convert_cert_to_pem_str(crt).encode('utf8'), perms):
+        return
     if hasattr(os, 'chmod') and os.path.exists(path):
         try:
             os.chmod(path, os.stat(path).st_mode | stat.S_IWRITE)
@@ -231,17 +279,17 @@ def download_issuer_ca(cert):
         log("Could not download issuer CA (error {}) for given certificate: {}".format(code, cert), error=True)
         return None
 
-    return x509.load_der_x509_certificate(resp.read(), default_backend())
+    return x509.load_der_x509_certificate(resp.read(), _BACKEND)
 
 
 # @brief determine all san domains on a given certificate
 def get_cert_domains(cert):
     san_cert = cert.extensions.get_extension_for_oid(ExtensionOID.SUBJECT_ALTERNATIVE_NAME)
-    domains = set()
-    domains.add(cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value)
+    domains = [cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value]
     if san_cert:
-        for d in san_cert.value:
-            domains.add(d.value)
+        domains.extend(d.value for d in san_cert.value)
+    # Keep the domains ordered (common name first) while removing duplicates
+    domains = list(collections.OrderedDict.fromkeys(domains))
     # Convert IDNA domain to correct representation and return the list
     return [x for x, _ in idna_convert(domains)]
 
@@ -263,9 +311,11 @@ def convert_cert_to_pem_str(cert):
     return cert.public_bytes(serialization.Encoding.PEM).decode('utf8')
 
 
-# @brief load a PEM certificate from str
+# @brief load a PEM certificate from str (or bytes)
 def convert_pem_str_to_cert(certdata):
-    return x509.load_pem_x509_certificate(certdata.encode('utf8'), default_backend())
+    if not isinstance(certdata, bytes):
+        certdata = certdata.encode('utf8')
+    return x509.load_pem_x509_certificate(certdata, _BACKEND)
 
 
 # @brief serialize cert/csr to DER bytes
@@ -275,12 +325,23 @@ def convert_cert_to_der_bytes(data):
 
 # @brief load a DER certificate from str
 def convert_der_bytes_to_cert(data):
-    return x509.load_der_x509_certificate(data, default_backend())
+    return x509.load_der_x509_certificate(data, _BACKEND)
+
+
+# @brief determine key signing algorithm and jwk data (cached per key)
+def get_key_alg_and_jwk(key):
+    # Keys are not weak-referenceable, so the key is kept in the cache to guarantee its id stays unique
+    cached = _key_alg_and_jwk_cache.get(id(key))
+    if not cached or cached[0] is not key:
+        cached = key, _determine_key_alg_and_jwk(key)
+        _key_alg_and_jwk_cache[id(key)] = cached
+    alg, jwk = cached[1]
+    return alg, dict(jwk)
 
 
 # @brief determine key signing algorithm and jwk data
 # @return key algorithm, signature algorithm, key numbers as a dict
-def get_key_alg_and_jwk(key):
+def _determine_key_alg_and_jwk(key):
     if isinstance(key, rsa.RSAPrivateKey):
         # See https://tools.ietf.org/html/rfc7518#section-6.3
         numbers = key.public_key().public_numbers()
@@ -349,9 +410,7 @@ def signature_of_str(key, string):
 
 # @brief hash a string
 def hash_of_str(string):
-    account_hash = hashes.Hash(hashes.SHA256(), backend=default_backend())
-    account_hash.update(string.encode('utf8'))
-    return account_hash.finalize()
+    return hashlib.sha256(string.encode('utf8')).digest()
 
 
 # @brief helper function to base64 encode for JSON objects
@@ -366,20 +425,30 @@ def bytes_to_base64url(b):
 # @param file string containing the path to the certificate file
 # @return True if target file is at least as new as the certificate, False otherwise
 def target_is_current(target, file):
-    if not os.path.isfile(target):
+    try:
+        target_stat = os.stat(target)
+    except OSError:
+        return False
+    if not stat.S_ISREG(target_stat.st_mode):
         return False
-    target_date = os.path.getmtime(target)
-    crt_date = os.path.getmtime(file)
-    return target_date >= crt_date
+    return target_stat.st_mtime >= os.stat(file).st_mtime
+
+
+# @brief check whether a string consists of ascii characters only
+def is_ascii(text):
+    if getattr(text, 'isascii', None):
+        # Python 3.7+ provides a fast builtin check
+        return text.isascii()
+    return all(ord(c) < 128 for c in text)
 
 
 # @brief convert domain list to idna representation (if applicable
 def idna_convert(domainlist):
-    if any(ord(c) >= 128 for c in ''.join(domainlist)):
+    if not all(is_ascii(x) for x in domainlist):
         try:
             domaintranslation = list()
             for domain in domainlist:
-                if any(ord(c) >= 128 for c in domain):
+                if not is_ascii(domain):
                     # Translate IDNA domain name from a unicode domain (handle wildcards separately)
                     if domain.startswith('*.'):
                         idna_domain = "*.{}".format(domain[2:].encode('idna').decode('ascii'))